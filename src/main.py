@@ -2,22 +2,13 @@
 Purpose: Open Source CPAP Data Visualizer
 Creator: Wayne Taylor
 """
+import hashlib
 import os
 import tempfile
-from datetime import datetime, timedelta
+import threading
 import streamlit as st
-import pyedflib
-import pandas as pd
-import plotly.express as px
 
-st.set_page_config(
-    page_title="Open Source CPAP Data Visualizer",
-    page_icon="images/icon.png",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
-
-st.markdown("""
+CUSTOM_CSS = """
     <style>
     .main {
         background-color: #f0f8ff !important;
@@ -59,7 +50,16 @@ st.markdown("""
         padding: 8px !important;
     }
     </style>
-    """, unsafe_allow_html=True)
+    """
+
+st.set_page_config(
+    page_title="Open Source CPAP Data Visualizer",
+    page_icon="images/icon.png",
+    layout="wide",
+    initial_sidebar_state="expanded"
+)
+
+st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
 
 st.sidebar.image("images/logo.png", use_column_width=True)
 
@@ -69,6 +69,106 @@ data_source = st.sidebar.selectbox(
 )
 
 TEMP_FILE_PATH = None
+DAY_NS = 86_400 * 10**9
+
+
+def _file_sig(path):
+    # Extra cache key so cached results are dropped when the file on disk changes
+    stat = os.stat(path)
+    return path, stat.st_mtime, stat.st_size
+
+
+@st.cache_data(show_spinner=False, ttl=30)
+def _scan_edfs(directory, mtime_ns):
+    with os.scandir(directory) as entries:
+        return sorted(entry.name for entry in entries if entry.name.endswith('.edf'))
+
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def get_edf(file_path, file_sig):
+    # Shared open reader; pyedflib closes the file when Streamlit evicts and drops it.
+    # Reads seek a per-handle pointer, so sessions must hold the lock while using it.
+    import pyedflib
+    return pyedflib.EdfReader(file_path), threading.Lock()
+
+
+@st.cache_data(show_spinner=False)
+def load_metadata(file_path, file_sig):
+    edf, edf_lock = get_edf(file_path, file_sig)
+    with edf_lock:
+        return edf.getHeader(), edf.getSignalLabels()
+
+
+def _daily_means(edf, signal_index, start_time):
+    # Stream the signal one calendar day at a time so only a day's worth of samples is in memory
+    import numpy as np
+    import pandas as pd
+    sample_rate = edf.getSampleFrequency(signal_index)
+    num_samples = edf.getNSamples()[signal_index]
+    # The mean commutes with the digital-to-physical affine map, so read raw integers and rescale the daily means
+    scale = (edf.getPhysicalMaximum(signal_index) - edf.getPhysicalMinimum(signal_index)) / (edf.getDigitalMaximum(signal_index) - edf.getDigitalMinimum(signal_index))
+    offset = edf.getPhysicalMinimum(signal_index) - edf.getDigitalMinimum(signal_index) * scale
+    # Midnight boundaries as int64 ns, mapped to sample offsets in one vectorised pass
+    start_ns = start_time.value
+    first_day_ns = start_time.normalize().value
+    num_days = int((start_ns - first_day_ns + num_samples / sample_rate * 1e9) // DAY_NS) + 1
+    day_ns = first_day_ns + np.arange(num_days + 1, dtype=np.int64) * DAY_NS
+    step_ns = int(round(1e9 / sample_rate))
+    stops = (-(-(day_ns[1:] - start_ns) // step_ns)).clip(0, num_samples)
+    starts = np.concatenate(([0], stops[:-1]))
+    days, means = [], []
+    for day, start, stop in zip(day_ns[:-1], starts, stops):
+        if stop > start:
+            block = edf.readSignal(signal_index, start=int(start), n=int(stop - start), digital=True)
+            days.append(day)
+            means.append(block.sum(dtype=np.int64) / block.size)
+            # Free the raw block before the next read so at most one day of samples is alive
+            del block
+    time_axis = pd.DatetimeIndex(np.array(days, dtype=np.int64).view('datetime64[ns]'), name='Time')
+    return pd.Series(np.asarray(means, dtype=float) * scale + offset, index=time_axis)
+
+
+@st.cache_data(show_spinner=False, persist="disk")
+def load_daily_data(file_path, ahi_signal, pressure_signal, file_sig):
+    import pandas as pd
+    series = {}
+    edf, edf_lock = get_edf(file_path, file_sig)
+    with edf_lock:
+        labels = edf.getSignalLabels()
+        start_time = pd.Timestamp(edf.getStartdatetime())
+        for signal_name in (ahi_signal, pressure_signal):
+            if signal_name not in series:
+                series[signal_name] = _daily_means(edf, labels.index(signal_name), start_time)
+    time_axis = next(iter(series.values())).index
+    if all(daily.index.equals(time_axis) for daily in series.values()):
+        # Signals cover the same days, so build the frame without aligning indexes
+        daily_data = pd.DataFrame({name: daily.to_numpy() for name, daily in series.items()}, index=time_axis)
+    else:
+        daily_data = pd.concat(series, axis=1, join='outer')
+    daily_data = daily_data.asfreq('D')
+    weekly_recommended = daily_data[pressure_signal].resample('W-SUN').mean().round(1)
+    daily_data['Recommended Pressure'] = weekly_recommended.reindex(daily_data.index, method='bfill')
+    return daily_data, weekly_recommended
+
+
+def get_default_signals(machine_type, signals):
+    defaults = {
+        "ResMed AirSense 11": {"AHI": "AHI", "MaskPress.95": "MaskPress.95"},
+        "ResMed AirCurve 10": {"AHI": "AHI", "MaskPress.95": "Pressure"},
+    }
+    if machine_type in defaults:
+        ahi_signal = defaults[machine_type]["AHI"] if defaults[machine_type]["AHI"] in signals else None
+        pressure_signal = defaults[machine_type]["MaskPress.95"] if defaults[machine_type]["MaskPress.95"] in signals else None
+    else:
+        ahi_signal = "AHI" if "AHI" in signals else None
+        pressure_signal = "MaskPress.95" if "MaskPress.95" in signals else None
+    return ahi_signal, pressure_signal
+
+
+@st.cache_data(show_spinner=False)
+def _csv_bytes(df):
+    return df.to_csv().encode('utf-8')
+
 
 # Display the "Understanding AHI" and "Understanding MaskPress.95" info at the top
 st.info("""
@@ -83,14 +183,19 @@ st.info("""
 if data_source == "Upload EDF File":
     uploaded_file = st.sidebar.file_uploader("Upload CPAP Data File", type=["edf"])
     if uploaded_file is not None:
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            temp_file.write(uploaded_file.getbuffer())
-            TEMP_FILE_PATH = temp_file.name
+        # Reuse the temp copy across reruns so the cached loaders keep hitting
+        upload_key = hashlib.sha256(uploaded_file.getbuffer()).hexdigest()
+        if st.session_state.get("upload_key") != upload_key:
+            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+                temp_file.write(uploaded_file.getbuffer())
+            st.session_state["upload_key"] = upload_key
+            st.session_state["upload_path"] = temp_file.name
+        TEMP_FILE_PATH = st.session_state["upload_path"]
 
 elif data_source == "Load from AirSense 11 Memory Card":
     memory_card_directory = st.sidebar.text_input("Enter the path to the memory card directory")
     if memory_card_directory:
-        edf_files = [f for f in os.listdir(memory_card_directory) if f.endswith('.edf')]
+        edf_files = _scan_edfs(memory_card_directory, os.stat(memory_card_directory).st_mtime_ns)
         if edf_files:
             selected_edf = st.sidebar.selectbox("Select EDF File", edf_files)
             TEMP_FILE_PATH = os.path.join(memory_card_directory, selected_edf)
@@ -98,76 +203,51 @@ elif data_source == "Load from AirSense 11 Memory Card":
             st.warning("No EDF files found in the specified directory.")
 
 if TEMP_FILE_PATH:
-    def load_metadata(file_path):
-        edf = pyedflib.EdfReader(file_path)
-        header = edf.getHeader()
-        signals = edf.getSignalLabels()
-        edf.close()
-        return header, signals
-    header, signals = load_metadata(TEMP_FILE_PATH)
+    # Heavy imports are deferred until there is a file to analyse, keeping the landing page light
+    import numpy as np
+    import pandas as pd
+    import plotly.graph_objects as go
+    file_sig = _file_sig(TEMP_FILE_PATH)
+    header, signals = load_metadata(TEMP_FILE_PATH, file_sig)
     machine_type = header.get("device", "Unknown Device")
     if machine_type == "Unknown Device":
         st.sidebar.write("Detected Machine: Unknown Device (Defaulting to ResMed AirSense 11)")
     else:
         st.sidebar.write(f"Detected Machine: {machine_type}")
-    def get_default_signals(machine_type, signals):
-        defaults = {
-            "ResMed AirSense 11": {"AHI": "AHI", "MaskPress.95": "MaskPress.95"},
-            "ResMed AirCurve 10": {"AHI": "AHI", "MaskPress.95": "Pressure"},
-        }
-        if machine_type in defaults:
-            ahi_signal = defaults[machine_type]["AHI"] if defaults[machine_type]["AHI"] in signals else None
-            pressure_signal = defaults[machine_type]["MaskPress.95"] if defaults[machine_type]["MaskPress.95"] in signals else None
-        else:
-            ahi_signal = "AHI" if "AHI" in signals else None
-            pressure_signal = "MaskPress.95" if "MaskPress.95" in signals else None
-        return ahi_signal, pressure_signal
-
     default_ahi_signal, default_pressure_signal = get_default_signals(machine_type, signals)
-    ahi_signal = st.sidebar.selectbox("Select AHI Signal", signals, index=signals.index(default_ahi_signal) if default_ahi_signal else 0)
-    pressure_signal = st.sidebar.selectbox("Select Pressure Signal (MaskPress.95)", signals, index=signals.index(default_pressure_signal) if default_pressure_signal else 0)
+    signal_index = {signal: i for i, signal in enumerate(signals)}
+    ahi_signal = st.sidebar.selectbox("Select AHI Signal", signals, index=signal_index.get(default_ahi_signal, 0))
+    pressure_signal = st.sidebar.selectbox("Select Pressure Signal (MaskPress.95)", signals, index=signal_index.get(default_pressure_signal, 0))
     if ahi_signal and pressure_signal:
-        def load_data(file_path, signal_name):
-            edf = pyedflib.EdfReader(file_path)
-            signal_index = edf.getSignalLabels().index(signal_name)
-            signal = edf.readSignal(signal_index)
-            sample_rate = edf.getSampleFrequency(signal_index)
-            start_time_str = edf.getStartdatetime().strftime("%Y-%m-%d %H:%M:%S")
-            num_samples = edf.getNSamples()[signal_index]
-            time_axis = [datetime.strptime(start_time_str, "%Y-%m-%d %H:%M:%S") + timedelta(seconds=i/sample_rate) for i in range(num_samples)]
-            edf.close()
-            return pd.DataFrame({'Time': time_axis, signal_name: signal})
-        df_ahi = load_data(TEMP_FILE_PATH, ahi_signal)
-        df_pressure = load_data(TEMP_FILE_PATH, pressure_signal)
-        df = pd.merge(df_ahi, df_pressure, on='Time')
-        df.set_index('Time', inplace=True)
-        daily_data = df.resample('D').mean()
-        daily_data['Recommended Pressure'] = daily_data[pressure_signal].resample('W-SUN').transform('mean').round(1)
+        daily_data, weekly_recommended = load_daily_data(TEMP_FILE_PATH, ahi_signal, pressure_signal, file_sig)
 
+        last_week = daily_data.tail(7)
         st.markdown("## AHI over last 7 days")
-        fig_ahi = px.line(daily_data.tail(7), x=daily_data.tail(7).index, y=ahi_signal)
+        fig_ahi = go.Figure(go.Scattergl(x=last_week.index, y=last_week[ahi_signal], mode='lines+markers'))
         fig_ahi.update_xaxes(tickformat="%b %d", title_text="Day")
         fig_ahi.update_yaxes(title_text="Recorded AHI")
         fig_ahi.add_hline(y=5, line_dash="dash", annotation_text="AHI Threshold (5)", line_color="red")
         st.plotly_chart(fig_ahi, use_container_width=True)
         st.markdown("## Recorded Pressure over last 7 days")
-        fig_pressure = px.line(daily_data.tail(7), x=daily_data.tail(7).index, y=pressure_signal)
+        fig_pressure = go.Figure(go.Scattergl(x=last_week.index, y=last_week[pressure_signal], mode='lines+markers'))
         fig_pressure.update_xaxes(tickformat="%b %d", title_text="Day")
         fig_pressure.update_yaxes(title_text="Recorded Pressure (cmH2O)")
         st.plotly_chart(fig_pressure, use_container_width=True)
-        weekly_recommended = daily_data['Recommended Pressure'].resample('W-SUN').mean()  # Get weekly averages
         weekly_recommended_table = pd.DataFrame({
             'Week Start': weekly_recommended.index.date,
             'Recommended Pressure': [f"{pressure:.1f}" for pressure in weekly_recommended.values]
         })
-        weekly_recommended_table['Change from Previous Week'] = (weekly_recommended_table['Recommended Pressure'].astype(float).diff() / weekly_recommended_table['Recommended Pressure'].astype(float).shift(1) * 100).fillna(0).round(1)
-        weekly_recommended_table['Change from Previous Week'] = weekly_recommended_table['Change from Previous Week'].astype(str) + '%'  # Add percentage symbol
+        weekly_recommended_table['Change from Previous Week'] = (weekly_recommended_table['Recommended Pressure'].astype(float).pct_change(fill_method=None).fillna(0) * 100).round(1).astype(str) + '%'  # Add percentage symbol
+        # Colour each row by the sign of its weekly change; the first week has nothing to compare against
+        weekly_change = weekly_recommended_table['Change from Previous Week'].str.rstrip('%').astype(float)
+        row_colors = np.where(weekly_change > 0, 'color: red', 'color: green').astype(object)
+        row_colors[:1] = 'color: black'
         st.markdown("## Recommended Pressure Settings Over Time")
         recommended_pressure = st.dataframe(weekly_recommended_table.style.apply(
-            lambda x: ['color: black' if x.name == 0 else ('color: red' if float(x['Change from Previous Week'].strip('%')) > 0 else 'color: green') for i in x],
-            axis=1
+            lambda x: row_colors,
+            axis=0
         ), hide_index=True, use_container_width=True)
-        st.download_button(label="Download Data as CSV", data=daily_data.to_csv(), file_name="cpap_analysis.csv")
+        st.download_button(label="Download Data as CSV", data=_csv_bytes(daily_data), file_name="cpap_analysis.csv")
     else:
         st.warning("Please select valid signals for AHI and MaskPress.95.")
 else: